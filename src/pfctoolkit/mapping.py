@@ -3,14 +3,48 @@ Tools to perform Lesion Network Mapping with the Precomputed Connectome
 
 """
 import os
+import mmap
 import numpy as np
 import nibabel as nib
-from numba import jit
+from concurrent.futures import ThreadPoolExecutor
+from numba import jit, prange
 from nilearn import image
 from pfctoolkit import tools, datasets, surface
 
+try:
+    import cupy as cp
 
-def process_chunk(chunk, rois, config):
+    # CuPy being installed does not mean a GPU is usable (CPU-only cluster
+    # nodes often share an environment with GPU nodes); probe for a device
+    # before enabling the GPU path.
+    if cp.cuda.runtime.getDeviceCount() == 0:
+        cp = None
+except Exception:
+    cp = None
+
+
+def get_brain_masker(config):
+    """Build a masker for the whole-brain mask of a connectome.
+
+    Parameters
+    ----------
+    config : pfctoolkit.config.Config
+        Configuration of the precomputed connectome.
+
+    Returns
+    -------
+    brain_masker : NiftiMasker or GiftiMasker
+        Masker for the configured brain mask.
+
+    """
+    image_type = config.get("type")
+    if image_type == "volume":
+        return tools.NiftiMasker(datasets.get_img(config.get("mask")))
+    elif image_type == "surface":
+        return surface.GiftiMasker(datasets.get_img(config.get("mask")))
+
+
+def process_chunk(chunk, rois, config, brain_masker=None):
     """Compute chunk contribution to FC maps for a given list of ROIs.
 
     Parameters
@@ -21,11 +55,16 @@ def process_chunk(chunk, rois, config):
         List of ROI paths to be processed.
     config : pfctoolkit.config.Config
         Configuration of the precomputed connectome.
+    brain_masker : NiftiMasker or GiftiMasker, default None
+        Masker for the whole-brain mask. The brain mask is identical across
+        chunks, so callers processing many chunks should build the masker
+        once and pass it in. If None, a new masker is built.
 
     Returns
     -------
     contributions : dict of ndarray
-        Dictionary containing contributions to network maps.
+        Dictionary of contribution arrays to network maps, with rows aligned
+        to the order of `rois`.
 
     """
     chunk_paths = {
@@ -35,106 +74,181 @@ def process_chunk(chunk, rois, config):
         "combo": config.get("combo"),
     }
     image_type = config.get("type")
+    if brain_masker is None:
+        brain_masker = get_brain_masker(config)
     if image_type == "volume":
-        brain_masker = tools.NiftiMasker(datasets.get_img(config.get("mask")))
+        idx_img = image.load_img(config.get("chunk_idx"))
         chunk_masker = tools.NiftiMasker(
-            image.math_img(f"img=={chunk}", img=config.get("chunk_idx"))
+            image.new_img_like(
+                idx_img, (idx_img.get_fdata() == chunk).astype(np.uint8)
+            )
         )
     elif image_type == "surface":
-        brain_masker = surface.GiftiMasker(datasets.get_img(config.get("mask")))
         chunk_masker = surface.GiftiMasker(
             surface.new_gifti_image(
                 datasets.get_img(config.get("chunk_idx")).agg_data() == chunk
             )
         )
-    brain_weights = np.array([brain_masker.transform(roi) for roi in rois])
-    chunk_weights = np.array([chunk_masker.transform(roi) for roi in rois])
-    brain_masks = np.array([(weights != 0) for weights in brain_weights])
-    chunk_masks = np.array([(weights != 0) for weights in chunk_weights])
+    brain_weights = brain_masker.transform_multi(rois)
+    chunk_weights = chunk_masker.transform_multi(rois)
     norm_weight = chunk_masker.transform(config.get("norm"))
     std_weight = chunk_masker.transform(config.get("std"))
 
-    norm_chunk_masks, std_chunk_masks = compute_chunk_masks(
+    std_chunk_masks, numerators, network_weights = compute_chunk_derived(
         chunk_weights, norm_weight, std_weight
     )
-    contributions = {}
-    for chunk_type in [
+    # Seed every field up front so no entry depends on the order the
+    # chunk_type loop fills them in.
+    contributions = {
+        "numerator": numerators,
+        "network_weight": network_weights,
+        "denominator": np.zeros(len(rois), dtype=np.float32),
+    }
+    chunk_types = [
         ("avgr", "AvgR"),
         ("fz", "AvgR_Fz"),
         ("t", "T"),
         ("combo", "Combo"),
-    ]:
-        chunk_data = np.load(
-            os.path.join(chunk_paths[chunk_type[0]], f"{chunk}_{chunk_type[1]}.npy")
+    ]
+    chunk_files = [
+        os.path.join(chunk_paths[name], f"{chunk}_{suffix}.npy")
+        for name, suffix in chunk_types
+    ]
+    # The chunk shape is invariant across chunk_types, so validate it once up
+    # front; the memory-mapped peek only reads the .npy header.
+    expected_shape = (config.get("chunk_size"), config.get("brain_size"))
+    first_shape = np.load(chunk_files[0], mmap_mode="r").shape
+    if first_shape != expected_shape:
+        raise TypeError(
+            f"Chunk expected to have shape {expected_shape} but"
+            f" instead has shape {first_shape}!"
         )
-        expected_shape = (config.get("chunk_size"), config.get("brain_size"))
-        if chunk_data.shape != expected_shape:
-            raise TypeError(
-                f"Chunk expected to have shape {expected_shape} but"
-                f" instead has shape {chunk_data.shape}!"
-            )
-        if chunk_type[0] == "combo":
-            numerator = compute_numerator(norm_chunk_masks)
-            for i, roi in enumerate(rois):
-                denominator = compute_denominator(
-                    brain_weights,
-                    chunk_weights,
-                    brain_masks,
-                    chunk_masks,
-                    chunk_data,
-                    i,
+    # Prefetch the next chunk_type on a background thread so its pages are
+    # being read in while the current chunk_type computes. The context
+    # manager reaps the worker even if a compute step raises.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_chunk_data, chunk_files[0])
+        for i, chunk_type in enumerate(chunk_types):
+            chunk_data = future.result()
+            if i + 1 < len(chunk_files):
+                future = executor.submit(load_chunk_data, chunk_files[i + 1])
+            if chunk_type[0] == "combo":
+                # Restrict the product to voxels inside at least one ROI;
+                # rows and columns outside the union only ever multiply zero
+                # weights. int32 index arrays keep the gather indices at half
+                # the footprint of the default int64, helping them stay
+                # cache-resident.
+                chunk_union = np.flatnonzero(
+                    np.any(chunk_weights != 0, axis=0)
+                ).astype(np.int32)
+                brain_union = np.flatnonzero(
+                    np.any(brain_weights != 0, axis=0)
+                ).astype(np.int32)
+                # Column fancy-indexing yields F-ordered arrays; make the
+                # operands C-contiguous so the numba dot runs without per-row
+                # strided copies.
+                contributions["denominator"] = compute_denominators(
+                    np.ascontiguousarray(brain_weights[:, brain_union]),
+                    np.ascontiguousarray(chunk_weights[:, chunk_union]),
+                    np.ascontiguousarray(chunk_data[chunk_union][:, brain_union]),
+                )
+            else:
+                contributions[chunk_type[0]] = compute_network_maps(
+                    std_chunk_masks, chunk_data
                 )
-                contributions[roi]["numerator"] = numerator[i]
-                contributions[roi]["denominator"] = denominator
-        else:
-            network_maps = compute_network_maps(std_chunk_masks, chunk_data)
-            for i, roi in enumerate(rois):
-                if chunk_type[0] == "avgr":
-                    contributions[roi] = {
-                        chunk_type[0]: network_maps[i, :],
-                    }
-                else:
-                    contributions[roi][chunk_type[0]] = network_maps[i, :]
-    network_weights = compute_network_weights(std_chunk_masks)
-    for i, roi in enumerate(rois):
-        contributions[roi]["network_weight"] = network_weights[i]
     return contributions
 
 
-def update_atlas(contribution, atlas):
+def load_chunk_data(path):
+    """Memory-map a chunk file instead of reading it up front.
+
+    Pages stream in on demand while the chunk computations run, overlapping
+    disk I/O with compute, and the kernel readahead is tuned for the
+    sequential access pattern via madvise. The data is kept float32 so a
+    float64 chunk file cannot promote the matmuls to double precision. The
+    same cast transparently upcasts reduced-precision chunk files (e.g.
+    float16 saved to halve disk traffic), so lower-precision storage needs
+    no format change here.
+
+    Parameters
+    ----------
+    path : str
+        Path to a chunk .npy file.
+
+    Returns
+    -------
+    chunk_data : ndarray of float32
+        Memory-mapped chunk data.
+
+    """
+    chunk_data = np.load(path, mmap_mode="r")
+    if hasattr(chunk_data, "_mmap"):
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            chunk_data._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(mmap, "MADV_WILLNEED"):
+            # Kick off kernel readahead immediately so a caller prefetching
+            # the file ahead of use gets its pages resident by compute time.
+            chunk_data._mmap.madvise(mmap.MADV_WILLNEED)
+    return chunk_data.astype(np.float32, copy=False)
+
+
+def init_atlas(rois, config):
+    """Initialize empty atlas accumulators for a list of ROIs.
+
+    The atlas is laid out structure-of-arrays: one contiguous accumulator
+    array per field, indexed by integer ROI id, instead of one dict of
+    per-field arrays per ROI.
+
+    Parameters
+    ----------
+    rois : list of str
+        List of all ROI paths to be processed.
+    config : pfctoolkit.config.Config
+        Configuration of the precomputed connectome.
+
+    Returns
+    -------
+    atlas : dict
+        dict mapping field names to accumulator ndarrays, plus a "rois" entry
+        mapping each ROI path to its row index.
+
+    """
+    n_rois = len(rois)
+    brain_size = config.get("brain_size")
+    atlas = {
+        "rois": {roi: i for i, roi in enumerate(rois)},
+        "avgr": np.zeros((n_rois, brain_size), dtype=np.float32),
+        "fz": np.zeros((n_rois, brain_size), dtype=np.float32),
+        "t": np.zeros((n_rois, brain_size), dtype=np.float32),
+        "network_weight": np.zeros(n_rois, dtype=np.float32),
+        "numerator": np.zeros(n_rois, dtype=np.float32),
+        "denominator": np.zeros(n_rois, dtype=np.float32),
+    }
+    return atlas
+
+
+def update_atlas(contribution, atlas, rois):
     """Update atlas with chunk contributions.
 
     Parameters
     ----------
-    contribution : dict
-        dict containing FC and scaling factor contributions from a chunk.
+    contribution : dict of ndarray
+        Contribution arrays from a chunk, with rows aligned to `rois`.
     atlas : dict
-        dict containing in-progress FC maps and scaling factor accumulators.
+        Atlas accumulators from `init_atlas`.
+    rois : list of str
+        List of ROI paths the contribution rows correspond to.
 
     Returns
     -------
     atlas : dict
-        Updated dict containing in-progress FC maps and scaling factor
-        accumulators following consolidation of the contribution.
+        Updated atlas accumulators following consolidation of the
+        contribution.
 
     """
-    for roi in contribution.keys():
-        if roi in atlas:
-            atlas[roi]["avgr"] += contribution[roi]["avgr"]
-            atlas[roi]["fz"] += contribution[roi]["fz"]
-            atlas[roi]["t"] += contribution[roi]["t"]
-            atlas[roi]["network_weight"] += contribution[roi]["network_weight"]
-            atlas[roi]["numerator"] += contribution[roi]["numerator"]
-            atlas[roi]["denominator"] += contribution[roi]["denominator"]
-        else:
-            atlas[roi] = {
-                "avgr": contribution[roi]["avgr"],
-                "fz": contribution[roi]["fz"],
-                "t": contribution[roi]["t"],
-                "network_weight": contribution[roi]["network_weight"],
-                "numerator": contribution[roi]["numerator"],
-                "denominator": contribution[roi]["denominator"],
-            }
+    idx = np.array([atlas["rois"][roi] for roi in rois])
+    for field in ["avgr", "fz", "t", "network_weight", "numerator", "denominator"]:
+        atlas[field][idx] += contribution[field]
     return atlas
 
 
@@ -152,25 +266,31 @@ def publish_atlas(atlas, output_dir, config):
 
     """
     output_dir = os.path.abspath(output_dir)
-    image_type = config.get("type")
-    if image_type == "volume":
-        brain_masker = tools.NiftiMasker(datasets.get_img(config.get("mask")))
+    brain_masker = get_brain_masker(config)
+    if config.get("type") == "volume":
         extension = ".nii.gz"
-    elif image_type == "surface":
-        brain_masker = surface.GiftiMasker(datasets.get_img(config.get("mask")))
+    else:
         extension = ".gii"
-    for roi in atlas:
-        atlas[roi]["denominator"] = final_denominator(atlas[roi]["denominator"])
-        atlas[roi]["avgr"] = atlas[roi]["avgr"] / atlas[roi]["network_weight"]
-        atlas[roi]["fz"] = atlas[roi]["fz"] / atlas[roi]["network_weight"]
-        atlas[roi]["t"] = atlas[roi]["t"] / atlas[roi]["network_weight"]
-        scaling_factor = atlas[roi]["numerator"] / atlas[roi]["denominator"]
+    # ROIs that never intersected a chunk have zero network weight; their
+    # rows would publish as all-NaN maps via 0/0, so they are skipped below.
+    published = atlas["network_weight"] != 0
+    atlas["denominator"] = final_denominator(atlas["denominator"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaling_factor = np.reshape(
+            atlas["numerator"] / atlas["denominator"], (-1, 1)
+        )
+        network_weight = np.reshape(atlas["network_weight"], (-1, 1))
+        for map_type in [("avgr", "AvgR"), ("fz", "AvgR_Fz"), ("t", "T")]:
+            atlas[map_type[0]] = atlas[map_type[0]] / network_weight * scaling_factor
+    for roi, i in atlas["rois"].items():
+        if not published[i]:
+            print(f"No chunks contributed to {roi}, skipping output.")
+            continue
         subject_name = os.path.basename(roi).split(".nii")[0]
         for map_type in [("avgr", "AvgR"), ("fz", "AvgR_Fz"), ("t", "T")]:
             output_fname = f"{subject_name}_Precom_{map_type[1]}{extension}"
             output_path = os.path.join(output_dir, output_fname)
-            atlas[roi][map_type[0]] = atlas[roi][map_type[0]] * scaling_factor
-            out_img = brain_masker.inverse_transform(atlas[roi][map_type[0]])
+            out_img = brain_masker.inverse_transform(atlas[map_type[0]][i])
             out_img.to_filename(output_path)
     print(f"Network maps output to {output_dir}")
     print("Done!")
@@ -181,29 +301,16 @@ def final_denominator(denominator):
     return np.sqrt(denominator)
 
 
-@jit(nopython=True)
-def compute_network_weights(std_chunk_masks):
-    """Compute network weights.
-
-    Parameters
-    ----------
-    std_chunk_masks : ndarray
-        Chunk-masked ROIs weighted by BOLD standard deviation.
-
-    Returns
-    -------
-    network_weights : ndarray
-        Contribution to total network map weights.
-
-    """
-    network_weights = np.sum(std_chunk_masks, axis=1)
-    return network_weights
-
-
-@jit(nopython=True)
 def compute_network_maps(std_chunk_masks, chunk_data):
     """Compute network maps.
 
+    When CuPy is importable and a GPU is visible the product runs there: the
+    [n_rois, chunk_size] x [chunk_size, brain_size] sgemm is large enough
+    that the transfers are amortized many times over. Otherwise a plain 2D
+    float32 np.matmul dispatches to the linked BLAS, whose multithreaded
+    tiled sgemm beats both numba's dot and hand-rolled cache blocking for
+    this shape.
+
     Parameters
     ----------
     std_chunk_masks : ndarray
@@ -217,15 +324,27 @@ def compute_network_maps(std_chunk_masks, chunk_data):
         Network map contributions from chunk.
 
     """
-    network_maps = np.dot(std_chunk_masks, chunk_data)
+    # No-op when the masks are already C-contiguous float32; otherwise this
+    # pays for one small copy up front instead of a hidden copy inside BLAS.
+    std_chunk_masks = np.ascontiguousarray(std_chunk_masks, dtype=np.float32)
+    if cp is not None:
+        network_maps = cp.asnumpy(
+            cp.matmul(cp.asarray(std_chunk_masks), cp.asarray(chunk_data))
+        )
+    else:
+        network_maps = np.matmul(std_chunk_masks, chunk_data)
     return network_maps
 
 
-@jit(nopython=True)
-def compute_denominator(
-    brain_weights, chunk_weights, brain_masks, chunk_masks, chunk_data, i
-):
-    """Compute denominator contribution.
+@jit(nopython=True, parallel=True)
+def compute_denominators(brain_weights, chunk_weights, chunk_data):
+    """Compute denominator contributions for all ROIs in parallel.
+
+    Voxels outside an ROI carry zero weight and contribute nothing, so the
+    masked per-ROI sums reduce to a weighted row sum of a matrix product.
+    The per-ROI reductions are independent and run across cores via
+    `prange`. The caller may restrict all operands to the union of nonzero
+    voxels across ROIs to shrink the product.
 
     Parameters
     ----------
@@ -233,54 +352,32 @@ def compute_denominator(
         Brain-masked weighted ROIs.
     chunk_weights : ndarray
         Chunk-masked weighted ROIs.
-    brain_masks : ndarray
-        Brain-masked unweighted ROIs.
-    chunk_masks : ndarray
-        Chunk-masked unweighted ROIs.
     chunk_data : ndarray
-        Chunk data.
-    i : int
-        Index of processed ROI.
+        Chunk data, with rows/columns matching the weight arrays.
 
     Returns
     -------
-    denominator : float
-        Contribution to denominator.
+    denominators : ndarray
+        Contributions to denominators, one per ROI.
 
     """
-    chunk_masked = np.multiply(
-        np.reshape(chunk_weights[i][chunk_masks[i]], (-1, 1)),
-        chunk_data[chunk_masks[i], :],
-    )
-    brain_masked = np.multiply(
-        brain_weights[i][brain_masks[i]], chunk_masked[:, brain_masks[i]]
-    )
-    denominator = np.sum(brain_masked)
-    return denominator
-
-
-@jit(nopython=True)
-def compute_numerator(norm_chunk_masks):
-    """Compute numerator contribution.
-
-    Parameters
-    ----------
-    norm_chunk_masks : ndarray
-        ROI chunk masks weighted with BOLD norms.
-
-    Returns
-    -------
-    numerator : float
-        Numerator contribution
+    n_rois = brain_weights.shape[0]
+    denominators = np.zeros(n_rois, dtype=np.float32)
+    for i in prange(n_rois):
+        denominators[i] = np.sum(
+            np.multiply(brain_weights[i], np.dot(chunk_weights[i], chunk_data))
+        )
+    return denominators
 
-    """
-    numerator = np.sum(norm_chunk_masks, axis=1)
-    return numerator
 
+@jit(nopython=True, parallel=True)
+def compute_chunk_derived(chunk_weights, norm_weight, std_weight):
+    """Compute weighted chunk masks, numerators, and network weights.
 
-@jit(nopython=True)
-def compute_chunk_masks(chunk_weights, norm_weight, std_weight):
-    """Compute weighted chunk masks.
+    One fused pass over `chunk_weights`: each weight is read once, multiplied
+    by the norm and std weightings, and accumulated into the numerator and
+    network weight sums while the std-weighted mask is written out. The
+    norm-weighted mask is only ever summed, so it is never materialized.
 
     Parameters
     ----------
@@ -293,12 +390,27 @@ def compute_chunk_masks(chunk_weights, norm_weight, std_weight):
 
     Returns
     -------
-    norm_weighted_chunk_masks : ndarray
-        ROI chunk masks weighted with BOLD norms.
-    std_weighted_chunk_masks : ndarray
+    std_chunk_masks : ndarray of float32
         ROI chunk masks weighted with BOLD standard deviations.
+    numerators : ndarray of float32
+        Numerator contributions, one per ROI.
+    network_weights : ndarray of float32
+        Contributions to total network map weights, one per ROI.
 
     """
-    norm_weighted_chunk_masks = np.multiply(chunk_weights, norm_weight)
-    std_weighted_chunk_masks = np.multiply(chunk_weights, std_weight)
-    return norm_weighted_chunk_masks, std_weighted_chunk_masks
+    n_rois, chunk_size = chunk_weights.shape
+    std_chunk_masks = np.empty_like(chunk_weights)
+    numerators = np.zeros(n_rois, dtype=np.float32)
+    network_weights = np.zeros(n_rois, dtype=np.float32)
+    for i in prange(n_rois):
+        numerator = np.float32(0)
+        network_weight = np.float32(0)
+        for j in range(chunk_size):
+            weight = chunk_weights[i, j]
+            numerator += weight * norm_weight[j]
+            std_weighted = weight * std_weight[j]
+            std_chunk_masks[i, j] = std_weighted
+            network_weight += std_weighted
+        numerators[i] = numerator
+        network_weights[i] = network_weight
+    return std_chunk_masks, numerators, network_weights
@@ -18,23 +18,23 @@ from natsort import natsorted
 
 
 @jit(nopython=True)
-def extract_chunk_signals(connectome_mat, roi_mat):
+def extract_chunk_signals(connectome_mat, roi_idx):
     """Extract Chunk TC Signal from a connectome subject.
 
     Parameters
     ----------
     connectome_mat : ndarray
         Connectome subject TC matrix.
-    roi_mat : ndarray
-        Chunk ROI binary mask
+    roi_idx : ndarray of int32
+        Indices of chunk ROI voxels within the brain mask.
 
     Returns
     -------
     roi_masked_tc : ndarray
-        TC signals extracted from connectome TC according to ROI binary mask
+        TC signals extracted from connectome TC according to ROI voxel indices
 
     """
-    roi_masked_tc = connectome_mat[:, roi_mat > 0]
+    roi_masked_tc = connectome_mat[:, roi_idx]
     return roi_masked_tc
 
 
@@ -101,20 +101,20 @@ def make_combo_chunk(agg_combo_chunk, chunk_bold, bold):
     return np.add(agg_combo_chunk, np.dot(chunk_bold.T, bold))
 
 
-def make_fz_maps(connectome_files, roi_mat):
+def make_fz_maps(connectome_files, roi_idx):
     """Make Fz Maps for a chunk ROI and a connectome subject.
 
     Parameters
     ----------
     connectome_files : (str, str)
         Tuple of paths for connectome subject TC matrix and TC norm vector.
-    roi_mat : ndarray
-        Brain-masked binary chunk ROI with shape (<size of brain>,)
+    roi_idx : ndarray of int32
+        Indices of chunk ROI voxels within the brain mask.
 
     """
     connectome_mat = np.load(connectome_files[0]).astype(np.float32)
     connectome_norms_mat = np.load(connectome_files[1]).astype(np.float32)
-    chunk_tc = extract_chunk_signals(connectome_mat, roi_mat)
+    chunk_tc = extract_chunk_signals(connectome_mat, roi_idx)
     corr_num = dot(connectome_mat.T, chunk_tc)
     corr_denom = dot(
         connectome_norms_mat.reshape(-1, 1),
@@ -306,6 +306,9 @@ def precomputed_connectome_fc_chunk(
     # Get binary chunk roi in brain-space
     chunk_roi = masker.transform(chunk_idx_mask) == chunk_idx
     chunk_size = int(np.sum(chunk_roi))
+    # Integer gather indices: the per-subject column extraction walks only
+    # the chunk voxels instead of scanning the whole boolean mask.
+    chunk_roi_idx = np.flatnonzero(chunk_roi).astype(np.int32)
 
     # Initialize Welford Maps
     count = 0
@@ -315,7 +318,7 @@ def precomputed_connectome_fc_chunk(
     # For each connectome subject
     for connectome_file in tqdm(connectome_files):
         # Calculate Fz maps from a connectome subject
-        fz_welford = make_fz_maps(connectome_file, chunk_roi)
+        fz_welford = make_fz_maps(connectome_file, chunk_roi_idx)
         # Update Welford Maps
         count, mean, M2 = welford_update_map(count, mean, M2, fz_welford)
 
@@ -381,6 +384,7 @@ def precomputed_connectome_combo_chunk(
     # Get binary chunk roi in brain-space
     chunk_roi = masker.transform(chunk_idx_mask) == chunk_idx
     chunk_size = int(np.sum(chunk_roi))
+    chunk_roi_idx = np.flatnonzero(chunk_roi).astype(np.int32)
 
     # For each connectome subject aggregate to combo chunk
     agg_combo_chunk = np.zeros((chunk_size, brain_size), dtype=np.float32)
@@ -392,7 +396,7 @@ def precomputed_connectome_combo_chunk(
             f" the connectome has {bold.shape[1]}"
             " voxels."
         )
-        chunk_bold = bold[:, chunk_roi.astype(bool)]
+        chunk_bold = bold[:, chunk_roi_idx]
         agg_combo_chunk = make_combo_chunk(agg_combo_chunk, chunk_bold, bold)
 
     # Save to file
@@ -29,7 +29,7 @@ class GiftiMasker:
         self.mask_shape = self.mask_data.shape
         self.mask_size = np.prod(self.mask_shape)
 
-    def transform(self, giimg=None, weight=False):
+    def transform(self, giimg=None, weight=False, out=None):
         """Masks Gifti file into 1D array. Retypes to float32.
 
         Parameters
@@ -42,6 +42,9 @@ class GiftiMasker:
         weight : bool, default False
             If True, transform the niimg with weighting. If False, transform the niimg
             without weighting.
+        out : numpy.ndarray, default None
+            Preallocated float32 array to write the masked signals into. If None, a new
+            array is allocated.
 
         Returns
         -------
@@ -59,7 +62,36 @@ class GiftiMasker:
             img = np.multiply(self.mask_data, giimg_data)
         else:
             img = giimg_data
-        return np.take(img, self.mask_idx)
+        if out is None:
+            return np.take(img, self.mask_idx)
+        np.take(img, self.mask_idx, out=out)
+        return out
+
+    def transform_multi(self, giimgs):
+        """Masks a list of Gifti files into a 2D array.
+
+        The output is allocated once and each image is masked directly into
+        its row, avoiding the list-of-arrays intermediate and second copy of
+        `np.array([transform(img) for img in imgs])`.
+
+        Parameters
+        ----------
+        giimgs : list of Giimg-like objects
+            Images to mask. Each item is accepted in the same forms as
+            `transform`.
+
+        Returns
+        -------
+        region_signals : numpy.ndarray, shape (len(giimgs), mask vertices)
+            Masked Gifti files, one row per input image.
+
+        """
+        region_signals = np.empty(
+            (len(giimgs), self.mask_idx.size), dtype=np.float32
+        )
+        for i, giimg in enumerate(giimgs):
+            self.transform(giimg, out=region_signals[i])
+        return region_signals
 
     def inverse_transform(self, flat_giimg=None):
         """Unmasks 1D array into 3D Gifti file. Retypes to float32.
@@ -137,7 +137,9 @@ def get_voxel_conn_map(x, y, z, map_type, config):
     if image_type == "volume":
         brain_masker = NiftiMasker(datasets.get_img(config.get("mask")))
         chunk_masker = NiftiMasker(
-            image.math_img(f"img=={chunk}", img=config.get("chunk_idx"))
+            image.new_img_like(
+                chunk_map, (chunk_map.get_fdata() == chunk).astype(np.uint8)
+            )
         )
     elif image_type == "surface":
         brain_masker = surface.GiftiMasker(datasets.get_img(config.get("mask")))
@@ -188,7 +190,7 @@ class NiftiMasker:
         self.mask_shape = self.mask_data.shape
         self.mask_size = np.prod(self.mask_shape)
 
-    def transform(self, niimg=None, weight=False):
+    def transform(self, niimg=None, weight=False, out=None):
         """Masks 3D Nifti file into 1D array. Retypes to float32.
 
         Parameters
@@ -200,6 +202,9 @@ class NiftiMasker:
         weight : bool, default False
             If True, transform the niimg with weighting. If False, transform the niimg
             without weighting.
+        out : numpy.ndarray, default None
+            Preallocated float32 array to write the masked signals into. If None, a new
+            array is allocated.
 
         Returns
         -------
@@ -212,7 +217,36 @@ class NiftiMasker:
             img = np.multiply(self.mask_data, niimg)
         else:
             img = niimg
-        return np.take(img.flatten(), self.mask_idx)
+        if out is None:
+            return np.take(img.flatten(), self.mask_idx)
+        np.take(img.flatten(), self.mask_idx, out=out)
+        return out
+
+    def transform_multi(self, niimgs):
+        """Masks a list of 3D Nifti files into a 2D array.
+
+        The output is allocated once and each image is masked directly into
+        its row, avoiding the list-of-arrays intermediate and second copy of
+        `np.array([transform(img) for img in imgs])`.
+
+        Parameters
+        ----------
+        niimgs : list of Niimg-like objects
+            Images to mask. Each item is passed through `check_niimg`, so paths
+            and image objects are both accepted.
+
+        Returns
+        -------
+        region_signals : numpy.ndarray, shape (len(niimgs), mask voxels)
+            Masked Nifti files, one row per input image.
+
+        """
+        region_signals = np.empty(
+            (len(niimgs), self.mask_idx.size), dtype=np.float32
+        )
+        for i, niimg in enumerate(niimgs):
+            self.transform(niimg, out=region_signals[i])
+        return region_signals
 
     def inverse_transform(self, flat_niimg=None):
         """Unmasks 1D array into 3D Nifti file. Retypes to float32.